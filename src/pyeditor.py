@@ -1,8 +1,15 @@
 import curses
 from curses.textpad import Textbox
 from os.path import isfile
-from sys import modules, argv
+from sys import modules, argv, maxsize
+from bisect import bisect_left, bisect_right, insort
+from array import array
+from difflib import SequenceMatcher
+from queue import Queue
+import threading
+import unicodedata
 import io
+import re
 
 try:
     import pyperclip
@@ -19,8 +26,20 @@ class TextBuffer(object):
     """
     Basic object for storing text
     """
-    def __init__(self, text):
+    def __init__(self, text, tablen=4):
         self.lines = text.split('\n')
+        self.tablen = tablen
+        # Cached display widths of each line, see line_widths()
+        self.widths = [None] * len(self.lines)
+        # Objects notified by set_text about the lines it replaced
+        self.listeners = []
+
+    def add_listener(self, listener):
+        """
+        Register an object with an update(r1, r2, lines) method
+        It is called after set_text replaces lines r1..r2 with lines
+        """
+        self.listeners.append(listener)
 
     def get_lines(self):
         return self.lines
@@ -59,7 +78,93 @@ class TextBuffer(object):
     def set_text(self, r1, c1, r2, c2, text):
         if self.is_valid(r1, c1) and self.is_valid(r2, c2):
             line = self.lines[r1][:c1] + text + self.lines[r2][c2:]
-            self.lines[r1:r2+1] = line.split('\n')
+            new_lines = line.split('\n')
+            self.lines[r1:r2+1] = new_lines
+            self.widths[r1:r2+1] = [None] * len(new_lines)
+            for listener in self.listeners:
+                listener.update(r1, r2, new_lines)
+
+    def calc_widths(self, line):
+        """
+        Returns False if line is plain ASCII without tabs, otherwise
+        a tuple (cols, xs) where cols are the buffer columns at which
+        the grapheme clusters of line start and xs are the screen
+        columns of those clusters
+        Both lists end with the length and the display width of line
+        """
+        if line.isascii() and '\t' not in line:
+            return False
+
+        cols = []
+        xs = []
+        x = 0
+        joined = False # Previous character was a zero width joiner
+        for col, ch in enumerate(line):
+            if ch == '\t':
+                width = self.tablen - (x % self.tablen)
+            elif cols and (joined or unicodedata.combining(ch) or
+                           unicodedata.category(ch) in ('Mn', 'Me', 'Cf')):
+                # Part of the previous grapheme cluster
+                joined = ch == '\u200d'
+                continue
+            elif unicodedata.east_asian_width(ch) in ('W', 'F'):
+                width = 2
+            else:
+                width = 1
+            joined = ch == '\u200d'
+            cols.append(col)
+            xs.append(x)
+            x += width
+        cols.append(len(line))
+        xs.append(x)
+        return cols, xs
+
+    def line_widths(self, i):
+        """
+        Returns the cached result of calc_widths for line i
+        """
+        widths = self.widths[i]
+        if widths is None:
+            widths = self.calc_widths(self.lines[i])
+            self.widths[i] = widths
+        return widths
+
+    def col_to_screen(self, r, c):
+        """
+        Returns the screen column (without the line numbering)
+        of buffer column c in line r
+        """
+        widths = self.line_widths(r)
+        if not widths:
+            return c
+        cols, xs = widths
+        k = bisect_right(cols, c) - 1
+        return xs[k] + max(c - cols[-1], 0)
+
+    def screen_to_col(self, r, x):
+        """
+        Returns the buffer column of the grapheme cluster in
+        line r that covers screen column x
+        """
+        widths = self.line_widths(r)
+        if not widths:
+            return min(x, len(self.lines[r]))
+        cols, xs = widths
+        k = bisect_right(xs, x) - 1
+        return cols[max(k, 0)]
+
+    def align_col(self, r, c, forward=False):
+        """
+        Returns c moved to the start of the grapheme cluster it
+        falls in, or to the start of the next cluster if forward
+        """
+        widths = self.line_widths(r)
+        if not widths or c > len(self.lines[r]):
+            return c
+        cols = widths[0]
+        if forward:
+            return cols[bisect_left(cols, c)]
+        return cols[bisect_right(cols, c) - 1]
 
     def is_valid(self, r, c):
         """
@@ -72,6 +177,268 @@ class TextBuffer(object):
             return False;
         return True;
 
+class WordIndex(object):
+    """
+    Sorted index of the identifiers in a TextBuffer, used for
+    word completion
+    The index is built in a background thread and afterwards only
+    the lines changed by TextBuffer.set_text are rescanned
+    """
+    word_re = re.compile(r'[^\W\d]\w*')
+
+    def __init__(self, buf):
+        self.lock = threading.Lock()
+        self.line_words = [] # Words found on each line
+        self.counts = {} # Number of occurences of each word
+        self.words = [] # Sorted list of the keys of self.counts
+        self.pending = [] # Updates received before the build finished
+        self.ready = False
+
+        buf.add_listener(self)
+        lines = list(buf.get_lines())
+        worker = threading.Thread(target=self.build, args=(lines,))
+        worker.daemon = True
+        worker.start()
+
+    def scan(self, line):
+        return tuple(self.word_re.findall(line))
+
+    def build(self, lines):
+        line_words = [self.scan(line) for line in lines]
+        counts = {}
+        for words in line_words:
+            for word in words:
+                counts[word] = counts.get(word, 0) + 1
+        words = sorted(counts)
+
+        # Only swap the results in while holding the lock so
+        # set_text is not kept waiting by the build
+        with self.lock:
+            self.line_words = line_words
+            self.counts = counts
+            self.words = words
+            for r1, r2, new_words in self.pending:
+                self.apply(r1, r2, new_words)
+            self.pending = []
+            self.ready = True
+
+    def update(self, r1, r2, lines):
+        new_words = [self.scan(line) for line in lines]
+        with self.lock:
+            if self.ready:
+                self.apply(r1, r2, new_words)
+            else:
+                self.pending.append((r1, r2, new_words))
+
+    def apply(self, r1, r2, new_words):
+        """
+        Replace the words of lines r1..r2 with new_words
+        Must be called with self.lock held
+        """
+        for words in self.line_words[r1:r2+1]:
+            for word in words:
+                self.remove(word)
+        for words in new_words:
+            for word in words:
+                self.add(word)
+        self.line_words[r1:r2+1] = new_words
+
+    def add(self, word):
+        count = self.counts.get(word, 0)
+        if count == 0:
+            insort(self.words, word)
+        self.counts[word] = count + 1
+
+    def remove(self, word):
+        count = self.counts[word] - 1
+        if count == 0:
+            del self.counts[word]
+            del self.words[bisect_left(self.words, word)]
+        else:
+            self.counts[word] = count
+
+    def complete(self, prefix, limit=10):
+        """
+        Returns up to limit indexed words starting with prefix
+        """
+        found = []
+        with self.lock:
+            i = bisect_left(self.words, prefix)
+            while i < len(self.words) and len(found) < limit:
+                word = self.words[i]
+                if not word.startswith(prefix):
+                    break
+                if word != prefix:
+                    found.append(word)
+                i += 1
+        return found
+
+class LineDiff(object):
+    """
+    Tracks the lines of a TextBuffer that were added, changed or
+    deleted compared to the file on disk
+    The file is stored as an array of line hashes; a background thread
+    diffs again only the hunks around the lines changed by set_text
+    """
+    def __init__(self, buf):
+        self.base = array('q') # Hashes of the lines on disk
+        self.curr = array('q') # Hashes of the lines in the buffer
+        # Sorted list of (start, end, base_start, base_end) where lines
+        # start..end-1 of the buffer replace base_start..base_end-1 on disk
+        self.hunks = []
+        # Bumped by the worker every time self.hunks changes
+        self.generation = 0
+        self.queue = Queue()
+
+        buf.add_listener(self)
+        self.set_base(buf.get_lines())
+        worker = threading.Thread(target=self.work)
+        worker.daemon = True
+        worker.start()
+
+    def set_base(self, lines):
+        """
+        Use lines as the contents of the file on disk
+        """
+        self.queue.put(('base', list(lines)))
+
+    def update(self, r1, r2, lines):
+        self.queue.put(('edit', r1, r2, [hash(line) for line in lines]))
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            hunks = self.hunks
+            if item[0] == 'base':
+                self.rebase(item[1])
+            else:
+                self.apply(*item[1:])
+            if self.hunks != hunks:
+                self.generation += 1
+
+    def rebase(self, lines):
+        self.base = array('q', [hash(line) for line in lines])
+        self.curr = array('q', self.base)
+        self.hunks = []
+
+    def apply(self, r1, r2, hashes):
+        """
+        Replace lines r1..r2 with hashes and diff the hunks
+        touching them again
+        """
+        hunks = self.hunks
+        start = r1
+        end = r2 + 1
+
+        # Find the hunks overlapping or next to the edited lines
+        first = bisect_left(hunks, (start,))
+        if first > 0 and hunks[first-1][1] >= start:
+            first -= 1
+        last = first
+        while last < len(hunks) and hunks[last][0] <= end:
+            start = min(start, hunks[last][0])
+            end = max(end, hunks[last][1])
+            last += 1
+
+        # Outside of hunks the lines are equal, only shifted
+        offset = 0
+        if first > 0:
+            offset = hunks[first-1][3] - hunks[first-1][1]
+        base_start = start + offset
+        if last > first:
+            offset = hunks[last-1][3] - hunks[last-1][1]
+        base_end = end + offset
+
+        self.curr[r1:r2+1] = array('q', hashes)
+        delta = len(hashes) - (r2 + 1 - r1)
+        matcher = SequenceMatcher(None, self.base[base_start:base_end],
+                                  self.curr[start:end+delta], autojunk=False)
+        new_hunks = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            if tag != 'equal':
+                new_hunks.append((start + j1, start + j2, base_start + i1, base_start + i2))
+        for s, e, bs, be in hunks[last:]:
+            new_hunks.append((s + delta, e + delta, bs, be))
+
+        # Replace the list instead of changing it so readers never see it half done
+        self.hunks = hunks[:first] + new_hunks
+
+    def hunk_row(self, hunk):
+        """
+        Returns the line a hunk is marked on
+        Deleted lines are marked on the line above them, or on
+        the first line if they were at the top of the file
+        """
+        start, end = hunk[0], hunk[1]
+        if start == end and start > 0:
+            return start - 1
+        return start
+
+    def marks(self, top, bottom):
+        """
+        Returns a dict mapping the changed lines between top and
+        bottom to '+' (added), '~' (changed), '_' (lines deleted below)
+        or '^' (lines deleted above)
+        """
+        hunks = self.hunks
+        marks = {}
+        for i in range(max(bisect_left(hunks, (top,)) - 1, 0), len(hunks)):
+            hunk = hunks[i]
+            start, end, base_start, base_end = hunk
+            if start > bottom + 1:
+                break
+            if start == end:
+                kind = '_' if start > 0 else '^'
+                marks.setdefault(self.hunk_row(hunk), kind)
+                continue
+            kind = '+' if base_start == base_end else '~'
+            for row in range(max(start, top), min(end, bottom + 1)):
+                marks[row] = kind
+        return marks
+
+    def next_change(self, row):
+        """
+        Returns the line the next hunk after row is marked on, or None
+        """
+        hunks = self.hunks
+        # Hunks starting before row - 1 are always marked before row
+        for i in range(bisect_left(hunks, (row - 1,)), len(hunks)):
+            if self.hunk_row(hunks[i]) > row:
+                return self.hunk_row(hunks[i])
+        return None
+
+    def prev_change(self, row):
+        """
+        Returns the line the last hunk before row is marked on, or None
+        """
+        hunks = self.hunks
+        # Hunks starting after row + 1 are always marked after row
+        for i in range(bisect_right(hunks, (row + 1, maxsize)) - 1, -1, -1):
+            if self.hunk_row(hunks[i]) < row:
+                return self.hunk_row(hunks[i])
+        return None
+
+class Completion(object):
+    """
+    Struct to hold the state of the word completion popup
+    """
+    def __init__(self, row, col, end, prefix, items):
+        self.row = row
+        self.col = col # Buffer column where the word starts
+        self.end = end # Buffer column where the word ends
+        self.prefix = prefix
+        self.items = items
+        self.index = 0
+
+    def next(self):
+        self.index = (self.index + 1) % len(self.items)
+
+    def prev(self):
+        self.index = (self.index - 1) % len(self.items)
+
+    def get_item(self):
+        return self.items[self.index]
+
 class Selection(object):
     """
     Struct to hold the starting and ending coordinates of
@@ -127,7 +494,7 @@ class EdState(object):
     """
     def __init__(self, ed):
         self._row = ed.row
-        self._col = ed.col + ed.line_x
+        self._col = ed.col
         self._top = ed.top
         self._bottom = ed.bottom
         self._left = ed.left
@@ -135,7 +502,7 @@ class EdState(object):
 
     def update(self, ed):
         self._row = ed.row
-        self._col = ed.col + ed.line_x
+        self._col = ed.col
         self._top = ed.top
         self._bottom = ed.bottom
         self._left = ed.left
@@ -143,7 +510,7 @@ class EdState(object):
 
     def restore(self, ed):
         ed.row = self._row
-        ed.col = self._col - ed.line_x
+        ed.col = self._col
         ed.top = self._top
         ed.bottom = self._bottom
         ed.left = self._left
@@ -159,13 +526,16 @@ class Editor(object):
         self.stdscr = stdscr
         self.filename = filename
         text = self.read_from_file(filename)
+        # Tab length (n spaces)
+        self.tablen = 4
         # Buffers
-        self.text_buf = TextBuffer(text)
+        self.text_buf = TextBuffer(text, self.tablen)
         self.copy_buf = TextBuffer('')
         self.help_buf = self.init_helpbuf()
         self.curr_buf = self.text_buf # Current active buffer
         # /Buffers
         self.sel = Selection()
+        # Cursor position, self.col is a column in the buffer
         self.row = 0
         self.col = 0
         self.run = True
@@ -175,17 +545,27 @@ class Editor(object):
         self.height = size[0]
         # Status bar color
         self.status_cl = curses.color_pair(1)
+        # Colors of the diff markers
+        self.diff_cl = {'+': curses.color_pair(4),
+                        '~': curses.color_pair(5),
+                        '_': curses.color_pair(6),
+                        '^': curses.color_pair(6)}
         # First and last lines that are shown
         self.top = 0
         self.bottom = self.height - 1
-        # The width of the line numbering column
-        self.line_x = 5
-        # First and last column
+        # The width of the line numbering column, see update_gutter
+        self.line_x = 0
+        # First and last screen column of the text that are shown
+        # The last 4 columns of the screen are kept for the '...' marker
         self.left = 0
-        self.right = self.width - 1 - self.line_x
-        # Tab length (n spaces)
-        self.tablen = 4
+        self.right = 0
+        self.update_gutter()
         self.state = EdState(self)
+        # Word completion
+        self.words = WordIndex(self.text_buf)
+        self.compl = None # Completion popup, None if not shown
+        # Changes compared to the file on disk
+        self.diff = LineDiff(self.text_buf)
 
     def mode_norm(self):
         # Set to normal mode
@@ -206,7 +586,7 @@ class Editor(object):
         self.status_cl = curses.color_pair(3)
         self.state.update(self)
         self.row = 0
-        self.col = 5
+        self.col = 0
         self.top = 0
         self.bottom = self.height - 1
 
@@ -223,6 +603,7 @@ class Editor(object):
             f = io.open(self.filename, mode="w", encoding="utf-8")
             f.write('\n'.join(self.text_buf.get_lines()))
             f.close()
+            self.diff.set_base(self.text_buf.get_lines())
 
         except IOError as err:
             errmes = "Failed to write to file '" + self.filename + "'; IOError."
@@ -288,7 +669,14 @@ class Editor(object):
                w : Write to file\n\
                W : Save as\n\
                g : Scroll to top\n\
-               G : Scroll to bottom'
+               G : Scroll to bottom\n\
+               n : Jump to the next changed line\n\
+               N : Jump to the previous changed line\n\n\
+    Insert mode commands:\n\
+          Ctrl-N : Complete word / next completion\n\
+          Ctrl-P : Previous completion\n\
+      Tab, Enter : Accept completion\n\
+             ESC : Close completion popup'
 
         return TextBuffer(text)
 
@@ -305,11 +693,16 @@ class Editor(object):
             self.scroll_down(diff + 1)
 
     def cmp_scroll_horiz(self):
-        if self.col > self.right:
-            diff = self.col - self.right
+        buf = self.curr_buf
+        x = buf.col_to_screen(self.row, self.col)
+        # Last screen column of the cluster under the cursor, so wide
+        # characters are shown whole
+        x_end = buf.col_to_screen(self.row, buf.align_col(self.row, self.col + 1, True)) - 1
+        if x_end > self.right:
+            diff = x_end - self.right
             self.scroll_right(diff)
-        elif self.col < self.left + self.line_x:
-            diff = self.left + self.line_x - self.col
+        elif x < self.left:
+            diff = self.left - x
             self.scroll_left(diff)
 
     def cmp_scroll(self):
@@ -326,35 +719,71 @@ class Editor(object):
             self.top += n
             self.bottom += n
 
+    def update_gutter(self):
+        """
+        Size the line numbering column to fit the largest line number
+        followed by a column for the diff markers and a blank column
+        """
+        digits = max(len(str(len(self.text_buf.get_lines()))), 4)
+        line_x = digits + 2
+        if line_x != self.line_x:
+            self.line_x = line_x
+            self.right = self.left + self.width - 5 - self.line_x
+            self.cmp_scroll_horiz()
+
     def scroll_left(self, n):
         if (self.left - n) >= 0:
             self.left -= n
             self.right -= n
         else:
             self.left = 0
-            self.right = self.width - 1
+            self.right = self.width - 5 - self.line_x
 
     def scroll_right(self, n):
         self.right += n
         self.left += n
 
     def print_text(self, xpos, ypos, width, height):
+        # Markers for lines changed since the file was read or saved
+        marks = {}
+        if self.curr_buf is self.text_buf:
+            marks = self.diff.marks(self.top, self.top + self.height - 2)
+
         y = 0
         for i in range(self.top, self.top + self.height - 1):
             try:
                 self.stdscr.addstr(y, 0, str(i))
-                curr_line = self.curr_buf.get_line(i) + '\n'
-                println = curr_line[self.left : self.right - self.line_x]
-                # self.stdscr.addstr(y, self.line_x, println_2)
-
-                for col, ch in enumerate(println):
+                if i in marks:
+                    mark = marks[i]
+                    self.stdscr.addstr(y, self.line_x - 2, mark, self.diff_cl[mark])
+                curr_line = self.curr_buf.get_line(i)
+                widths = self.curr_buf.line_widths(i)
+
+                if not widths:
+                    # Plain ASCII line, every character takes up one cell
+                    cols = range(self.left, min(len(curr_line), self.right + 1) + 1)
+                    xs = cols
+                    first = 0
+                else:
+                    cols, xs = widths
+                    # First grapheme cluster that is fully shown
+                    first = bisect_left(xs, self.left)
+
+                for k in range(first, len(cols) - 1):
+                    if xs[k + 1] > self.right + 1:
+                        break
+                    col = cols[k]
+                    ch = curr_line[col : cols[k + 1]]
+                    if ch == '\t':
+                        ch = ' ' * (xs[k + 1] - xs[k])
+                    x = xs[k] - self.left + self.line_x
                     if self.sel.selected(i, col):
-                        self.stdscr.addstr(y, col + self.line_x, ch, curses.A_REVERSE)
+                        self.stdscr.addstr(y, x, ch, curses.A_REVERSE)
                     else:
-                        self.stdscr.addstr(y, col + self.line_x, ch)
+                        self.stdscr.addstr(y, x, ch)
 
                 # Print '...' if the line is cut off on the right
-                if self.right - self.line_x < len(curr_line) - 1:
+                if self.right < self.curr_buf.col_to_screen(i, len(curr_line)) - 1:
                     self.stdscr.addstr(y, self.width - 4, '...')
                 y += 1
 
@@ -365,27 +794,28 @@ class Editor(object):
 
     def inschar(self, ch):
         # Insert a character
-        inscol = self.col - self.line_x
+        inscol = self.col
         self.text_buf.set_text(self.row, inscol, self.row, inscol, chr(ch))
 
         if chr(ch) == '\n':
             self.row += 1
-            self.col = self.line_x
+            self.col = 0
             self.cmp_scroll()
         else:
             self.move_cursor_right(1)
 
     def instab(self):
         # Insert a tabulator
-        col = self.col - self.line_x
-        diff = self.tablen - (col % self.tablen)
+        col = self.col
+        x = self.text_buf.col_to_screen(self.row, col)
+        diff = self.tablen - (x % self.tablen)
         tab = diff * ' '
         self.text_buf.set_text(self.row, col, self.row, col, tab)
         self.move_cursor_right(diff)
 
     def delchar(self):
         # Delete a character
-        if self.col == self.line_x:
+        if self.col == 0:
             if self.row == 0:
                 # Delete the first char in the doc
                 self.text_buf.set_text(0, 0, 0, 1, '')
@@ -397,17 +827,126 @@ class Editor(object):
                 self.move_cursor_left(1)
                 self.text_buf.set_text(self.row, 0, self.row + 1, len(curr), prev + curr)
         else:
-            # Cursor is not at the beginning of a line so delete a character like normal
-            begincol = self.col - 1 - self.line_x
-            endcol = begincol + 1
+            # Cursor is not at the beginning of a line so delete the
+            # grapheme cluster before it, the same one move_cursor_left steps over
+            begincol = self.text_buf.align_col(self.row, self.col - 1)
+            endcol = self.col
             self.text_buf.set_text(self.row, begincol, self.row, endcol, '')
-            self.move_cursor_left(1)
+            self.col = begincol
+            self.cmp_scroll_horiz()
+
+    def open_completion(self):
+        """
+        Show the completion popup for the word under the cursor
+        The part of the word before the cursor is used as the prefix
+        """
+        col = self.col
+        line = self.text_buf.get_line(self.row)
+        start = col
+        while start > 0 and (line[start-1].isalnum() or line[start-1] == '_'):
+            start -= 1
+        end = col
+        while end < len(line) and (line[end].isalnum() or line[end] == '_'):
+            end += 1
+        prefix = line[start:col]
+        if prefix == '' or prefix[0].isdigit():
+            return
+
+        # The word under the cursor is in the index too, leave it out
+        word = line[start:end]
+        items = [item for item in self.words.complete(prefix, 11) if item != word]
+        if items:
+            self.compl = Completion(self.row, start, end, prefix, items[:10])
+            self.draw_completion()
+
+    def accept_completion(self):
+        """
+        Replace the whole word under the cursor with the
+        selected completion
+        """
+        word = self.compl.get_item()
+        start = self.compl.col
+        self.text_buf.set_text(self.row, start, self.row, self.compl.end, word)
+        self.col = start + len(word)
+        self.cmp_scroll_horiz()
+        self.compl = None
+
+    def draw_completion(self):
+        """
+        Draw the completion popup in its own window so
+        the rest of the screen does not have to be redrawn
+        """
+        items = self.compl.items
+        height = len(items)
+        item_w = max(self.cut_width(item, self.width)[1] for item in items)
+        width = min(item_w + 2, self.width - 1)
+
+        y = self.compl.row - self.top + 1
+        if y + height > self.height - 1:
+            # Not enough room below the cursor, show it above
+            y = max(self.compl.row - self.top - height, 0)
+            height = min(height, self.height - 1 - y)
+        x = self.text_buf.col_to_screen(self.compl.row, self.compl.col)
+        x = x + self.line_x - self.left
+        x = max(min(x, self.width - 1 - width), 0)
+
+        popup = curses.newwin(height, width, y, x)
+        # Keep the terminal cursor at the insertion point
+        popup.leaveok(True)
+        for i, item in enumerate(items[:height]):
+            attr = curses.A_REVERSE if i == self.compl.index else curses.A_NORMAL
+            text, text_w = self.cut_width(' ' + item, width)
+            try:
+                popup.addstr(i, 0, text + ' ' * (width - text_w), attr)
+            except curses.error:
+                # Writing the bottom right corner moves the cursor out of the window
+                pass
+        popup.noutrefresh()
+        self.place_cursor()
+        self.stdscr.noutrefresh()
+        curses.doupdate()
+
+    def cut_width(self, text, width):
+        """
+        Returns the longest start of text that fits in width
+        screen columns and its display width
+        """
+        widths = self.text_buf.calc_widths(text)
+        if not widths:
+            text = text[:width]
+            return text, len(text)
+        cols, xs = widths
+        k = bisect_right(xs, width) - 1
+        return text[:cols[k]], xs[k]
 
     def update_scr(self):
+        self.update_gutter()
         self.stdscr.clear()
         self.print_text(0, 0, self.height, self.width - 1)
         self.draw_status(0, self.height - 1)
-        self.stdscr.move(self.row - self.top, self.col - self.left)
+        self.place_cursor()
+        self.stdscr.refresh()
+
+    def place_cursor(self):
+        """
+        Move the terminal cursor to self.row, self.col
+        """
+        x = self.curr_buf.col_to_screen(self.row, self.col)
+        self.stdscr.move(self.row - self.top, x - self.left + self.line_x)
+
+    def draw_marks(self):
+        """
+        Redraw only the diff marker column of the shown lines
+        """
+        if self.curr_buf is not self.text_buf:
+            return
+        marks = self.diff.marks(self.top, self.top + self.height - 2)
+        last = min(self.top + self.height - 1, len(self.text_buf.get_lines()))
+        for y, i in enumerate(range(self.top, last)):
+            mark = marks.get(i, ' ')
+            attr = self.diff_cl.get(mark, curses.A_NORMAL)
+            self.stdscr.addstr(y, self.line_x - 2, mark, attr)
+        self.place_cursor()
         self.stdscr.refresh()
 
     def draw_status(self, xpos, ypos):
@@ -421,7 +960,7 @@ class Editor(object):
         else:
             txt_filename = 'Empty Buffer'
 
-        txt_cursorpos = '{} || {}:{}'.format(txt_filename, self.row + 1, self.col + 1 - self.line_x)
+        txt_cursorpos = '{} || {}:{}'.format(txt_filename, self.row + 1, self.col + 1)
         self.stdscr.addstr(ypos, xpos + self.width - 1 - len(txt_cursorpos), txt_cursorpos, self.status_cl)
 
     def set_cursor_startpos(self):
@@ -433,47 +972,54 @@ class Editor(object):
         line = self.curr_buf.get_line(0)
         for i, ch in enumerate(line):
             if ch != ' ':
-                self.col = i + self.line_x
+                self.col = i
                 return
-        self.col = self.line_x
+        self.col = 0
+
+    def move_cursor_vert(self, row):
+        """
+        Move the cursor to row keeping it in the same screen column
+        """
+        x = self.curr_buf.col_to_screen(self.row, self.col)
+        self.row = row
+        self.col = self.curr_buf.screen_to_col(self.row, x)
+        self.cmp_scroll()
 
     def move_cursor_down(self, n):
         if self.row < len(self.curr_buf.get_lines()) - 1:
-            self.row += n
-            self.cmp_scroll()
+            self.move_cursor_vert(self.row + n)
 
     def move_cursor_up(self, n):
         if self.row > 0:
-            self.row -= n
-            self.cmp_scroll()
+            self.move_cursor_vert(self.row - n)
 
     def move_cursor_left(self, n):
         new_col = self.col - n
-        if new_col < self.line_x and self.row > 0:
+        if new_col < 0 and self.row > 0:
             self.row -= 1
-            self.col = len(self.curr_buf.get_line(self.row)) + self.line_x
+            self.col = len(self.curr_buf.get_line(self.row))
             self.cmp_scroll()
             return
-        elif new_col >= self.line_x:
-            self.col = new_col
+        elif new_col >= 0:
+            self.col = self.curr_buf.align_col(self.row, new_col)
             self.cmp_scroll_horiz()
 
     def move_cursor_right(self, n):
         try:
             new_col = self.col + n
-            max_col = len(self.curr_buf.get_line(self.row)) + self.line_x
+            max_col = len(self.curr_buf.get_line(self.row))
         except IndexError:
             # Reached EOF
             return
 
         if new_col > max_col:
-            if self.row > len(self.curr_buf.get_lines()) - 1:
+            if self.row >= len(self.curr_buf.get_lines()) - 1:
                 return
-            self.col = self.line_x
+            self.col = 0
             self.row += 1
             self.cmp_scroll()
             return
-        self.col = new_col
+        self.col = self.curr_buf.align_col(self.row, new_col, True)
         self.cmp_scroll_horiz()
 
     def move_cursor_first_nonblank(self):
@@ -483,10 +1029,10 @@ class Editor(object):
         """
         for i, c in enumerate(self.text_buf.get_line(self.row)):
             if c != ' ':
-                self.col = i + self.line_x
+                self.col = i
                 self.cmp_scroll_horiz()
                 return
-        self.col = self.line_x
+        self.col = 0
         self.cmp_scroll_horiz()
 
     def select_right(self):
@@ -494,18 +1040,18 @@ class Editor(object):
         Add current char to selection and move cursor left
         """
         if self.sel.is_empty():
-            self.sel.set_start(self.row, self.col - self.line_x)
+            self.sel.set_start(self.row, self.col)
         self.move_cursor_right(1)
-        self.sel.set_end(self.row, self.col - self.line_x)
+        self.sel.set_end(self.row, self.col)
 
     def select_left(self):
         """
         Add current char to selection and move cursor right
         """
         if self.sel.is_empty():
-            self.sel.set_end(self.row, self.col - self.line_x)
+            self.sel.set_end(self.row, self.col)
         self.move_cursor_left(1)
-        self.sel.set_start(self.row, self.col - self.line_x)
+        self.sel.set_start(self.row, self.col)
 
     def yank(self):
         if not self.sel.is_empty():
@@ -514,7 +1060,7 @@ class Editor(object):
             self.sel.clear()
 
     def paste(self):
-        cur_col = self.col - self.line_x
+        cur_col = self.col
         buf = self.copy_buf.get_plaintext()
         self.text_buf.set_text(self.row, cur_col, self.row, cur_col, buf)
         self.move_cursor_right(len(buf))
@@ -527,7 +1073,7 @@ class Editor(object):
 
     def paste_from_clip(self):
         if imported('pyperclip'):
-            cur_col = self.col - self.line_x
+            cur_col = self.col
             buf = pyperclip.paste()
             self.text_buf.set_text(self.row, cur_col, self.row, cur_col, buf)
 
@@ -536,7 +1082,7 @@ class Editor(object):
             if len(lines) == 1:
                 self.move_cursor_right(len(lines[0]))
             else:
-                self.col = len(lines[-1]) + self.line_x
+                self.col = len(lines[-1])
                 self.row += len(lines) - 1
             # self.scroll_down(len(lines) - 1)
             self.cmp_scroll()
@@ -545,14 +1091,29 @@ class Editor(object):
         self.scroll_up(self.top)
         self.scroll_left(self.left)
         self.row = self.top
-        self.col = self.line_x
+        self.col = 0
 
     def scroll_to_bottom(self):
         dist = len(self.text_buf.get_lines()) - self.bottom
         self.scroll_down(dist)
         self.scroll_left(self.left)
         self.row = len(self.text_buf.get_lines()) - 1
-        self.col = self.line_x
+        self.col = 0
+
+    def jump_to_change(self, forward=True):
+        """
+        Move the cursor to the next (or previous) line
+        changed since the file was read or saved
+        """
+        if forward:
+            row = self.diff.next_change(self.row)
+        else:
+            row = self.diff.prev_change(self.row)
+        if row == None:
+            return
+        self.row = min(row, len(self.text_buf.get_lines()) - 1)
+        self.move_cursor_first_nonblank()
+        self.cmp_scroll_vert()
 
     def event_handler_normal(self, ch):
         """ Handle keypresses from self.stdscr.getch() """
@@ -584,12 +1145,12 @@ class Editor(object):
             self.move_cursor_right(1)
 
         elif ch == ord('A'): # Move to EOL and enter insert mode
-            self.col = len(self.text_buf.get_line(self.row)) + self.line_x
+            self.col = len(self.text_buf.get_line(self.row))
             self.cmp_scroll_horiz()
             self.mode_ins()
 
         elif ch == ord('$'): # Move to EOL
-            self.col = len(self.text_buf.get_line(self.row)) + self.line_x
+            self.col = len(self.text_buf.get_line(self.row))
             self.cmp_scroll_horiz()
 
         elif ch == ord('0'):
@@ -640,11 +1201,48 @@ class Editor(object):
         elif ch == ord('G'):
             self.scroll_to_bottom()
 
+        # """ Jumping between changes """
+        elif ch == ord('n'):
+            self.jump_to_change()
+
+        elif ch == ord('N'):
+            self.jump_to_change(False)
+
+    def event_handler_completion(self, ch):
+        """
+        Handle keypresses while the completion popup is shown
+        Returns True if the key was consumed by the popup
+        """
+        if ch == 14: # Ctrl-N : next completion
+            self.compl.next()
+            self.draw_completion()
+
+        elif ch == 16: # Ctrl-P : previous completion
+            self.compl.prev()
+            self.draw_completion()
+
+        elif ch == 9 or ch == 10: # TAB or Enter : accept
+            self.accept_completion()
+
+        elif ch == 27: # ESC : close the popup
+            self.compl = None
+
+        else:
+            self.compl = None
+            return False
+        return True
+
     def event_handler_insert(self, ch):
 
-        if ch == 27: # ESC : exit insert mode
+        if self.compl != None and self.event_handler_completion(ch):
+            return
+
+        if ch == 14: # Ctrl-N : word completion
+            self.open_completion()
+
+        elif ch == 27: # ESC : exit insert mode
             self.mode_norm()
-            if self.col > self.line_x: self.col -= 1
+            if self.col > 0: self.move_cursor_left(1)
 
         elif ch == 127 or ch == 8: # DEL or Backspace
             self.delchar()
@@ -677,9 +1275,21 @@ class Editor(object):
 
     def main(self):
         self.set_cursor_startpos()
+        # Wake up every 50ms so changes to the diff markers are drawn
+        self.stdscr.timeout(50)
         while self.run:
-            self.update_scr()
+            generation = self.diff.generation
+            # The completion popup redraws itself
+            if self.compl == None:
+                self.update_scr()
+
             ch = self.stdscr.getch()
+            while ch == -1:
+                if self.compl == None and self.diff.generation != generation:
+                    # Only the diff markers changed, leave the text alone
+                    generation = self.diff.generation
+                    self.draw_marks()
+                ch = self.stdscr.getch()
 
             if self.mode == 'normal':
                 self.event_handler_normal(ch)
@@ -698,9 +1308,18 @@ def init_curses():
     curses.noecho()
     curses.cbreak()
     curses.start_color()
+    # Diff markers use the terminal background if it is supported
+    try:
+        curses.use_default_colors()
+        background = -1
+    except curses.error:
+        background = curses.COLOR_BLACK
     curses.init_pair(1, curses.COLOR_WHITE, curses.COLOR_GREEN)
     curses.init_pair(2, curses.COLOR_WHITE, curses.COLOR_BLUE)
     curses.init_pair(3, curses.COLOR_WHITE, curses.COLOR_MAGENTA)
+    curses.init_pair(4, curses.COLOR_GREEN, background)
+    curses.init_pair(5, curses.COLOR_YELLOW, background)
+    curses.init_pair(6, curses.COLOR_RED, background)
     return stdscr
 
 def main():